@@ -4,40 +4,153 @@
 build_category_opml.py — Quét CHỈ các RSS CHUYÊN MỤC theo bộ pattern, xuất OPML gọn.
 Usage:
   python build_category_opml.py --sites sites.txt --patterns category_patterns.txt --out feeds.opml
+  (tuỳ chọn) --cache .state/seeds.sqlite — cache HTML seed + ETag/Last-Modified, seed không đổi trả về 304
 
 Heuristics:
   - Lấy <link rel="alternate" type="application/rss+xml"> và <a href> có chứa rss/feed/xml
   - Giữ lại feed nếu URL hoặc text/tiêu đề chứa 1 trong các pattern (không phân biệt hoa thường, bỏ dấu)
-Deps: requests, beautifulsoup4, lxml, unidecode
+Deps: aiohttp, selectolax, unidecode, pyahocorasick
 """
 from pathlib import Path
 import argparse
+import asyncio
 import html
+import re
+import sqlite3
+import unicodedata
 import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 
-import requests
-from bs4 import BeautifulSoup
+import aiohttp
+from selectolax.lexbor import LexborHTMLParser
 
 try:
-    from unidecode import unidecode
+    from unidecode import unidecode  # chỉ dùng cho chữ ngoài Latin (CJK, ...)
 except Exception:  # fallback nếu chưa có unidecode
     def unidecode(s: str) -> str:
         return s
 
+try:
+    import ahocorasick
+except Exception:  # fallback nếu chưa có pyahocorasick
+    ahocorasick = None
+
 UA = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) Category-RSS-Builder/1.0"
 TIMEOUT = 25
+CONCURRENCY = 20
+
+# href chứa rss, /feed hoặc kết thúc bằng .xml — 1 regex thay cho 3 phép so chuỗi
+_CANDIDATE_RE = re.compile(r"rss|/feed|\.xml$", re.I)
+
+# CSS selector dùng chung cho mọi trang (hằng số module, không dựng lại mỗi vòng lặp)
+_A_SEL = "a[href]"
+_LINK_SEL = 'link[rel~="alternate"][href]'
+
+
+def load_seed_cache(db: Path) -> dict[str, dict]:
+    """Đọc cache HTML seed (url -> etag/last_modified/final_url/body) từ sqlite."""
+    if not db.exists():
+        return {}
+    con = sqlite3.connect(db)
+    try:
+        rows = con.execute("SELECT url, etag, last_modified, final_url, body FROM seeds").fetchall()
+    except sqlite3.Error:
+        return {}
+    finally:
+        con.close()
+    return {
+        url: {"etag": etag, "last_modified": lm, "final_url": final_url, "body": body}
+        for url, etag, lm, final_url, body in rows
+    }
+
+
+def save_seed_cache(db: Path, updates: dict[str, dict]):
+    if not updates:
+        return
+    db.parent.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(db)
+    try:
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS seeds "
+            "(url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, final_url TEXT, body TEXT)"
+        )
+        con.executemany(
+            "INSERT OR REPLACE INTO seeds VALUES (?, ?, ?, ?, ?)",
+            [(u, m["etag"], m["last_modified"], m["final_url"], m["body"]) for u, m in updates.items()],
+        )
+        con.commit()
+    finally:
+        con.close()
+
+
+async def fetch(session: aiohttp.ClientSession, url: str, cache: dict, updates: dict) -> tuple[str, str]:
+    headers = {}
+    meta = cache.get(url)
+    if meta:
+        if meta["etag"]:
+            headers["If-None-Match"] = meta["etag"]
+        if meta["last_modified"]:
+            headers["If-Modified-Since"] = meta["last_modified"]
+    async with session.get(url, headers=headers, allow_redirects=True) as r:
+        if r.status == 304 and meta:
+            return meta["body"], meta["final_url"]
+        r.raise_for_status()
+        text, final = await r.text(), str(r.url)
+        etag, lm = r.headers.get("ETag"), r.headers.get("Last-Modified")
+        if etag or lm:
+            updates[url] = {"etag": etag, "last_modified": lm, "final_url": final, "body": text}
+        return text, final
+
+
+async def fetch_all(urls: list[str], cache_db: Path) -> list:
+    """Tải song song (conditional GET theo cache); phần tử lỗi được trả về dưới dạng Exception."""
+    cache = load_seed_cache(cache_db)
+    updates: dict[str, dict] = {}
+    sem = asyncio.Semaphore(CONCURRENCY)
+    timeout = aiohttp.ClientTimeout(total=TIMEOUT)
+    async with aiohttp.ClientSession(headers={"User-Agent": UA}, timeout=timeout) as session:
+        async def run(u):
+            async with sem:
+                return await fetch(session, u, cache, updates)
+        results = await asyncio.gather(*[run(u) for u in urls], return_exceptions=True)
+    save_seed_cache(cache_db, updates)
+    return results
 
 
-def fetch(url: str) -> tuple[str, str]:
-    r = requests.get(url, headers={"User-Agent": UA}, timeout=TIMEOUT, allow_redirects=True)
-    r.raise_for_status()
-    return r.text, r.url
+# "đ" không tách dấu được qua NFKD nên gập tay trước
+_VI_FOLD = str.maketrans("đĐ", "dD")
+# Ký tự ngoài ASCII và ngoài khối dấu kết hợp (U+0300–U+036F)
+_NON_LATIN_RE = re.compile(r"[^\x00-\x7f\u0300-\u036f]")
 
 
 def normalize(s: str) -> str:
-    s = (s or "")
-    s = unidecode(s)
-    return s.lower()
+    s = unicodedata.normalize("NFKD", (s or "").translate(_VI_FOLD))
+    if _NON_LATIN_RE.search(s):
+        return unidecode(s).lower()
+    # Tiếng Việt sau NFKD = chữ ASCII + dấu kết hợp → bỏ dấu bằng encode ascii
+    return s.encode("ascii", "ignore").decode("ascii").lower()
+
+
+def build_matcher(patterns: list[str]):
+    """Trả về hàm s -> bool: s có chứa ít nhất 1 pattern (Aho-Corasick, dựng 1 lần)."""
+    patterns = [p for p in patterns if p]
+    if not patterns:
+        return lambda s: False
+    if ahocorasick is None:
+        return lambda s: any(p in s for p in patterns)
+
+    automaton = ahocorasick.Automaton()
+    for p in patterns:
+        automaton.add_word(p, p)
+    automaton.make_automaton()
+
+    def matches(s: str) -> bool:
+        for _ in automaton.iter(s):
+            return True
+        return False
+
+    return matches
 
 
 def load_lines(p: Path) -> list[str]:
@@ -49,10 +162,16 @@ def load_lines(p: Path) -> list[str]:
 
 
 def is_candidate(href: str) -> bool:
-    u = (href or "").lower()
-    return ("rss" in u) or ("/feed" in u) or u.endswith(".xml")
+    return bool(_CANDIDATE_RE.search(href or ""))
+
+
+def feed_key(u: str) -> str:
+    """Khoá dedup: host viết thường, bỏ '/' cuối path và fragment (http://x/rss == http://X/rss/)."""
+    p = urllib.parse.urlsplit(u)
+    return urllib.parse.urlunsplit((p.scheme.lower(), p.netloc.lower(), p.path.rstrip("/"), p.query, ""))
 
 
+@lru_cache(maxsize=None)
 def title_from_url(u: str) -> str:
     p = urllib.parse.urlparse(u)
     host = p.hostname or ""
@@ -60,11 +179,54 @@ def title_from_url(u: str) -> str:
     return host if not path else f"{host}/{path}"
 
 
+# Matcher của mỗi tiến trình worker (dựng 1 lần trong init_worker)
+matches_pattern = None
+
+
+def init_worker(patterns_norm: list[str]):
+    global matches_pattern
+    matches_pattern = build_matcher(patterns_norm)
+
+
+def parse_page(page: tuple[str, str]) -> list[str]:
+    """Chạy trong worker: trả về các feed URL của 1 trang khớp pattern."""
+    html_text, final = page
+    tree = LexborHTMLParser(html_text)
+    # URL tuyệt đối -> text/title tốt nhất của <a> trỏ tới URL đó
+    candidates: dict[str, str] = {}
+
+    # 1) <link rel="alternate" ...> (rel được lọc ngay trong CSS selector)
+    for link in tree.css(_LINK_SEL):
+        typ = (link.attributes.get("type") or "").lower()
+        if ("rss" in typ) or ("xml" in typ):
+            candidates.setdefault(urllib.parse.urljoin(final, link.attributes.get("href") or ""), "")
+
+    # 2) <a href=...> chứa rss/feed/xml (hoặc trỏ tới feed đã thấy ở bước 1) — lấy text ngay trong lượt này
+    for a in tree.css(_A_SEL):
+        href = (a.attributes.get("href") or "").strip()
+        abs_url = urllib.parse.urljoin(final, href)
+        if not (is_candidate(href) or abs_url in candidates):
+            continue
+        if not candidates.get(abs_url):
+            candidates[abs_url] = a.attributes.get("title") or a.text(separator=" ", strip=True) or ""
+
+    # 3) Lọc theo pattern (URL hoặc text anchor)
+    kept: list[str] = []
+    for c, text in candidates.items():
+        nurl = normalize(c)
+        ntext = normalize(text)
+
+        if matches_pattern(nurl) or (ntext and matches_pattern(ntext)):
+            kept.append(c)
+    return kept
+
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--sites", required=True)
     ap.add_argument("--patterns", required=True)
     ap.add_argument("--out", required=True)
+    ap.add_argument("--cache", default=".state/seeds.sqlite")
     args = ap.parse_args()
 
     sites_path = Path(args.sites)
@@ -75,52 +237,25 @@ def main():
     patterns_norm = [normalize(x) for x in load_lines(pats_path)]
 
     all_feeds: dict[str, str] = {}
+    seen_keys: set[str] = set()
+
+    results = asyncio.run(fetch_all(seeds, Path(args.cache)))
+    pages: list[tuple[str, str]] = []
 
-    for url in seeds:
-        try:
-            html_text, final = fetch(url)
-        except Exception as e:
-            print(f"❌ {url}: {e}")
+    for url, res in zip(seeds, results):
+        if isinstance(res, Exception):
+            print(f"❌ {url}: {res}")
             continue
+        pages.append(res)
 
-        soup = BeautifulSoup(html_text, "lxml")
-        candidates: set[str] = set()
-
-        # 1) <link rel="alternate" ...>
-        for link in soup.find_all("link", href=True):
-            rel = " ".join(link.get("rel", [])).lower()
-            typ = (link.get("type") or "").lower()
-            if ("alternate" in rel) and (("rss" in typ) or ("xml" in typ)):
-                candidates.add(urllib.parse.urljoin(final, link["href"]))
-
-        # 2) <a href=...> chứa rss/feed/xml
-        for a in soup.find_all("a", href=True):
-            href = a["href"].strip()
-            if is_candidate(href):
-                candidates.add(urllib.parse.urljoin(final, href))
-
-        # 3) Lọc theo pattern (URL hoặc text anchor)
-        for c in candidates:
-            nurl = normalize(c)
-
-            # lấy text/title tương ứng nếu có
-            text = ""
-            for a in soup.find_all("a", href=True):
-                if urllib.parse.urljoin(final, a["href"].strip()) == c:
-                    text = (a.get("title") or a.get_text(" ", strip=True) or "")
-                    break
-            ntext = normalize(text)
-
-            keep = False
-            for pat in patterns_norm:
-                if pat in nurl or (ntext and pat in ntext):
-                    keep = True
-                    break
-            if not keep:
-                continue
-
-            if c not in all_feeds:
-                all_feeds[c] = title_from_url(c)
+    # Phân tích HTML (CPU-bound) song song trên nhiều tiến trình
+    with ProcessPoolExecutor(initializer=init_worker, initargs=(patterns_norm,)) as ex:
+        for kept in ex.map(parse_page, pages, chunksize=4):
+            for c in kept:
+                k = feed_key(c)
+                if k not in seen_keys:
+                    seen_keys.add(k)
+                    all_feeds[c] = title_from_url(c)
 
     # 4) Ghi OPML
     head = """<?xml version="1.0" encoding="UTF-8"?>
@@ -131,18 +266,17 @@ def main():
   <body>
     <outline text="VN Category Feeds" title="VN Category Feeds">
 """
-    body_lines = []
-    for url, title in sorted(all_feeds.items(), key=lambda kv: kv[0]):
-        body_lines.append(
-            f'      <outline type="rss" text="{html.escape(title)}" title="{html.escape(title)}" xmlUrl="{html.escape(url)}" />'
-        )
-
-    tail = """
-    </outline>
+    tail = """    </outline>
   </body>
 </opml>
 """
-    out_path.write_text(head + "\n".join(body_lines) + tail, encoding="utf-8")
+    # Ghi thẳng từng dòng ra file, không dựng cả chuỗi OPML trong bộ nhớ
+    with out_path.open("w", encoding="utf-8") as f:
+        f.write(head)
+        for url, title in sorted(all_feeds.items(), key=lambda kv: kv[0]):
+            t = html.escape(title)
+            f.write(f'      <outline type="rss" text="{t}" title="{t}" xmlUrl="{html.escape(url)}" />\n')
+        f.write(tail)
     print(f"✅ Wrote {out_path} with {len(all_feeds)} feeds (category-only).")
 
 
@@ -1,58 +1,151 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import re, sys, time, html, urllib.parse
+import re, sys, time, html, asyncio, sqlite3, urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-import requests
-from bs4 import BeautifulSoup
+import aiohttp
+from lxml import etree
 
 IN_FILE  = Path("rss_indices.txt")
 OUT_FILE = Path("feeds.opml")
+CACHE_DB = Path(".state/seeds.sqlite")   # cache HTML seed + ETag/Last-Modified (conditional GET)
 
 UA = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) RSS-Crawler/1.0 (+https://example.local)"
 TIMEOUT = 20
+CONCURRENCY = 20
+PROBE_SUFFIXES = ("/rss", "/rss.htm", "/rss.html")
 
-RSS_HINT_PATTERNS = [
-    re.compile(r"\.rss($|\?)", re.I),
-    re.compile(r"/rss($|[/?#])", re.I),
-    re.compile(r"/rss\.htm[l]?$", re.I),
-]
+# Gộp các dấu hiệu URL RSS (.rss, /rss, /rss.htm[l]) vào 1 regex duy nhất
+_RSS_RE = re.compile(r"\.rss($|\?)|/rss($|[/?#])|/rss\.html?$", re.I)
 
 def looks_like_rss(url: str) -> bool:
     u = url.strip()
     if not u: return False
-    return any(p.search(u) for p in RSS_HINT_PATTERNS)
+    return bool(_RSS_RE.search(u))
 
 def absolutize(base, href):
     return urllib.parse.urljoin(base, href)
 
-def fetch(url):
-    r = requests.get(url, headers={"User-Agent": UA}, timeout=TIMEOUT)
-    r.raise_for_status()
-    return r.text, r.url
+def load_seed_cache():
+    # url -> {etag, last_modified, final_url, body}
+    if not CACHE_DB.exists():
+        return {}
+    con = sqlite3.connect(CACHE_DB)
+    try:
+        rows = con.execute("SELECT url, etag, last_modified, final_url, body FROM seeds").fetchall()
+    except sqlite3.Error:
+        return {}
+    finally:
+        con.close()
+    return {u: {"etag": et, "last_modified": lm, "final_url": fin, "body": body} for u, et, lm, fin, body in rows}
+
+def save_seed_cache(updates):
+    if not updates:
+        return
+    CACHE_DB.parent.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(CACHE_DB)
+    try:
+        con.execute("CREATE TABLE IF NOT EXISTS seeds "
+                    "(url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, final_url TEXT, body TEXT)")
+        con.executemany("INSERT OR REPLACE INTO seeds VALUES (?, ?, ?, ?, ?)",
+                        [(u, m["etag"], m["last_modified"], m["final_url"], m["body"]) for u, m in updates.items()])
+        con.commit()
+    finally:
+        con.close()
+
+async def fetch(session, url, cache, updates):
+    headers = {}
+    meta = cache.get(url)
+    if meta:
+        if meta["etag"]:
+            headers["If-None-Match"] = meta["etag"]
+        if meta["last_modified"]:
+            headers["If-Modified-Since"] = meta["last_modified"]
+    async with session.get(url, headers=headers) as r:
+        if r.status == 304 and meta:
+            return meta["body"], meta["final_url"]
+        r.raise_for_status()
+        text, final = await r.text(), str(r.url)
+        etag, lm = r.headers.get("ETag"), r.headers.get("Last-Modified")
+        if etag or lm:
+            updates[url] = {"etag": etag, "last_modified": lm, "final_url": final, "body": text}
+        return text, final
+
+async def fetch_all(urls):
+    # Kết quả giữ đúng thứ tự urls; lỗi được trả về dưới dạng Exception
+    cache, updates = load_seed_cache(), {}
+    sem = asyncio.Semaphore(CONCURRENCY)
+    timeout = aiohttp.ClientTimeout(total=TIMEOUT)
+    async with aiohttp.ClientSession(headers={"User-Agent": UA}, timeout=timeout) as session:
+        async def run(u):
+            async with sem:
+                return await fetch(session, u, cache, updates)
+        results = await asyncio.gather(*[run(u) for u in urls], return_exceptions=True)
+    save_seed_cache(updates)
+    return results
+
+class _FeedLinkTarget:
+    # Parser target kiểu SAX cho lxml: chỉ xem thuộc tính của <a>/<link>, không dựng DOM
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.feeds = {}  # dict làm "set có thứ tự": giữ đúng thứ tự xuất hiện trong trang
+
+    def start(self, tag, attrib):
+        if tag == "a":
+            # 1) <a href=...> có chứa /rss hoặc .rss
+            href = (attrib.get("href") or "").strip()
+            if looks_like_rss(href):
+                self.feeds.setdefault(absolutize(self.base_url, href))
+        elif tag == "link":
+            # 2) <link rel="alternate" type="application/rss+xml"> (nếu có)
+            rel = (attrib.get("rel") or "").lower().split()
+            t   = (attrib.get("type") or "").lower()
+            if "alternate" in rel and ("rss" in t or "xml" in t) and attrib.get("href") is not None:
+                self.feeds.setdefault(absolutize(self.base_url, attrib["href"]))
+
+    def end(self, tag):
+        pass
+
+    def data(self, data):
+        pass
+
+    def close(self):
+        return self.feeds
 
 def extract_feeds_from_page(html_text, base_url):
-    soup = BeautifulSoup(html_text, "lxml")
-    feeds = set()
-
-    # 1) <a href=...> có chứa /rss hoặc .rss
-    for a in soup.find_all("a", href=True):
-        href = a["href"].strip()
-        if looks_like_rss(href):
-            feeds.add(absolutize(base_url, href))
-
-    # 2) <link rel="alternate" type="application/rss+xml"> (nếu có)
-    for link in soup.find_all("link", href=True):
-        rel = " ".join(link.get("rel", [])).lower()
-        t   = (link.get("type") or "").lower()
-        if "alternate" in rel and ("rss" in t or "xml" in t):
-            feeds.add(absolutize(base_url, link["href"]))
+    target = _FeedLinkTarget(base_url)
+    parser = etree.HTMLParser(target=target)
+    try:
+        parser.feed(html_text)
+        parser.close()
+    except etree.LxmlError:
+        pass  # trang rỗng/hỏng: giữ những gì đã thấy
+    feeds = target.feeds
 
     # 3) fallback: nếu chính URL kết thúc bằng /rss(.html|.htm), coi là feed
     if looks_like_rss(base_url):
-        feeds.add(base_url)
+        feeds.setdefault(base_url)
 
-    return feeds
+    return list(feeds)
 
+def parse_pages(pool, results):
+    # extract_feeds_from_page trên pool; trang tải lỗi -> None (giữ đúng thứ tự results)
+    ok = [r for r in results if not isinstance(r, Exception)]
+    parsed = iter(pool.map(extract_feeds_from_page, [t for t, _ in ok], [f for _, f in ok], chunksize=4))
+    return [None if isinstance(r, Exception) else next(parsed) for r in results]
+
+def feed_key(u: str) -> str:
+    # Khoá dedup: host viết thường, bỏ '/' cuối path và fragment (http://x/rss == http://X/rss/)
+    p = urllib.parse.urlsplit(u)
+    return urllib.parse.urlunsplit((p.scheme.lower(), p.netloc.lower(), p.path.rstrip("/"), p.query, ""))
+
+def merge_feeds(all_feeds, feeds):
+    # all_feeds: feed_key -> URL gặp đầu tiên
+    for u in feeds:
+        all_feeds.setdefault(feed_key(u), u)
+
+@lru_cache(maxsize=None)
 def tidy_title_from_url(u: str) -> str:
     p = urllib.parse.urlparse(u)
     host = p.hostname or ""
@@ -71,17 +164,17 @@ def write_opml(feed_urls):
   <body>
     <outline text="Vietnam News" title="Vietnam News">
 """
-    body = []
-    for url in sorted(feed_urls):
-        title = html.escape(tidy_title_from_url(url))
-        href  = html.escape(url)
-        body.append(f'      <outline type="rss" text="{title}" title="{title}" xmlUrl="{href}" />')
-    tail = """
-    </outline>
+    tail = """    </outline>
   </body>
 </opml>
 """
-    OUT_FILE.write_text(head + "\n".join(body) + tail, encoding="utf-8")
+    with OUT_FILE.open("w", encoding="utf-8") as f:
+        f.write(head)
+        for url in sorted(feed_urls):
+            title = html.escape(tidy_title_from_url(url))
+            href  = html.escape(url)
+            f.write(f'      <outline type="rss" text="{title}" title="{title}" xmlUrl="{href}" />\n')
+        f.write(tail)
 
 def main():
     if not IN_FILE.exists():
@@ -89,39 +182,47 @@ def main():
         sys.exit(1)
 
     seeds = [l.strip() for l in IN_FILE.read_text(encoding="utf-8").splitlines() if l.strip() and not l.strip().startswith("#")]
-    all_feeds = set()
-    for url in seeds:
-        try:
-            html_text, final_url = fetch(url)
-        except Exception as e:
-            print(f"❌ Lỗi tải {url}: {e}")
-            continue
-
-        # Thử trích ngay từ trang seed
-        feeds = extract_feeds_from_page(html_text, final_url)
-        all_feeds |= feeds
-
-        # Nếu seed là trang chủ, thử các biến thể phổ biến
-        if not feeds:
-            for suffix in ("/rss", "/rss.htm", "/rss.html"):
-                probe = urllib.parse.urljoin(final_url.rstrip("/") + "/", suffix.lstrip("/"))
-                try:
-                    txt, fin = fetch(probe)
-                    feeds2   = extract_feeds_from_page(txt, fin)
-                    if feeds2:
-                        print(f"[+] Found RSS index via {probe} -> {len(feeds2)} feeds")
-                        all_feeds |= feeds2
-                        break
-                except Exception:
-                    pass
-
-        print(f"[i] {url} -> +{len(feeds)} feed(s) (tổng hiện tại: {len(all_feeds)})")
+    all_feeds = {}
+    results = asyncio.run(fetch_all(seeds))
+
+    # Phân tích HTML (CPU-bound) trên nhiều tiến trình
+    with ProcessPoolExecutor() as pool:
+        no_feed_bases = []
+        for url, res, feeds in zip(seeds, results, parse_pages(pool, results)):
+            if feeds is None:
+                print(f"❌ Lỗi tải {url}: {res}")
+                continue
+
+            # Thử trích ngay từ trang seed
+            merge_feeds(all_feeds, feeds)
+
+            # Nếu seed là trang chủ, để dành thử các biến thể phổ biến
+            if not feeds:
+                no_feed_bases.append(res[1])
+
+            print(f"[i] {url} -> +{len(feeds)} feed(s) (tổng hiện tại: {len(all_feeds)})")
+
+        # Tải song song mọi biến thể, rồi lấy biến thể đầu tiên (theo thứ tự) có feed
+        probes = [
+            [urllib.parse.urljoin(base.rstrip("/") + "/", suffix.lstrip("/")) for suffix in PROBE_SUFFIXES]
+            for base in no_feed_bases
+        ]
+        probe_results = asyncio.run(fetch_all([p for group in probes for p in group]))
+        probe_feeds = parse_pages(pool, probe_results)
+
+    n = len(PROBE_SUFFIXES)
+    for i, group in enumerate(probes):
+        for probe, feeds2 in zip(group, probe_feeds[i * n:(i + 1) * n]):
+            if feeds2:
+                print(f"[+] Found RSS index via {probe} -> {len(feeds2)} feeds")
+                merge_feeds(all_feeds, feeds2)
+                break
 
     if not all_feeds:
         print("⚠️ Không phát hiện feed nào. Kiểm tra lại seeds / mạng / chặn bot.")
         sys.exit(2)
 
-    write_opml(all_feeds)
+    write_opml(all_feeds.values())
     print(f"✅ Đã viết {OUT_FILE} với {len(all_feeds)} feed.")
     print("• Import OPML này vào Inoreader hoặc dùng trực tiếp trong workflow gửi mail của bạn.")
 
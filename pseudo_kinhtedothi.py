@@ -4,13 +4,14 @@ pseudo_kinhtedothi.py — Selenium pseudo RSS builder (v6: no user-data-dir + Fi
 
 - KHÔNG dùng --user-data-dir (tránh xung đột profile)
 - Nếu Chrome không mở được session → fallback sang Firefox headless
+- Thử trước bằng requests + selectolax (HTML tĩnh); chỉ mở trình duyệt khi thiếu link
 - Cuộn trang + thử click “Xem thêm / Tải thêm / Load more / Trang sau”
 - Lấy link *.html trực tiếp từ DOM (ít phụ thuộc CSS class)
 - Ghi debug_links.txt & debug_page.html khi rỗng
 - Xuất RSS XML: pseudo_kinhtedothi.xml
 
 Cài đặt:
-  pip install selenium webdriver-manager beautifulsoup4 lxml
+  pip install selenium webdriver-manager requests selectolax
   (khuyến nghị) pip install undetected-chromedriver
 
 ENV (Windows CMD: `set KEY=VALUE`):
@@ -22,10 +23,15 @@ ENV (Windows CMD: `set KEY=VALUE`):
   KINHTEDOTHI_USE_UC    (1|0; mặc định: 1 — dùng undetected-chromedriver nếu có)
 """
 
-import os, re, time, html
+import os, re, time, urllib.parse
 from datetime import datetime, timezone
-from typing import List, Tuple
+from typing import Iterator, List, Tuple
+from xml.sax.saxutils import escape
 
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from selectolax.lexbor import LexborHTMLParser
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service as ChromeService
 from selenium.webdriver.firefox.service import Service as FxService
@@ -49,6 +55,58 @@ HEADLESS   = os.environ.get("KINHTEDOTHI_HEADLESS", "1") != "0"
 FOCUS_SUB  = (os.environ.get("KINHTEDOTHI_FOCUS") or "").strip().lower()
 USE_UC     = os.environ.get("KINHTEDOTHI_USE_UC", "1") == "1"
 
+UA = ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+      "AppleWebKit/537.36 (KHTML, like Gecko) "
+      "Chrome/127.0.0.0 Safari/537.36")
+DOMAIN = "https://kinhtedothi.vn"
+
+# Cùng logic với filter_links, chạy trong trang; arguments = [focus, max_items, domain]
+COLLECT_LINKS_JS = r"""
+  const [focus, max, domain] = arguments;
+  const seen = new Set(), out = [];
+  for (const a of document.querySelectorAll('a[href$=".html"]')) {
+    const href = a.href;
+    if (!href.startsWith(domain)) continue;
+    const hl = href.toLowerCase();
+    // nếu lọc quá chặt, vẫn chấp nhận link dạng ...12345.html
+    if (focus && !hl.includes(focus) && !/\d+\.html$/.test(hl)) continue;
+    if (seen.has(href)) continue;
+    seen.add(href);
+    let text = (a.title || a.textContent || '').trim();
+    if (!text) text = href.split('/').pop().replace(/-/g, ' ').trim();
+    out.push([href, text.replace(/\s+/g, ' ')]);
+    if (out.length >= max) break;
+  }
+  return out;
+"""
+
+_WS         = re.compile(r"\s+")
+_DIGIT_HTML = re.compile(r"\d+\.html$")
+
+# Session dùng chung: keep-alive + retry nhẹ cho lỗi mạng/5xx
+SESSION = requests.Session()
+SESSION.headers["User-Agent"] = UA
+_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32,
+                       max_retries=Retry(total=2, backoff_factor=0.3,
+                                         status_forcelist=(500, 502, 503, 504)))
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
+# Selector cố định — khai báo 1 lần thay vì dựng lại ở mỗi vòng smart_load
+ARTICLE_CSS  = "a[href$='.html']"
+# 1 lần execute_script/vòng: click mọi nút “Xem thêm/Tải thêm/Load more/Trang sau/>>”
+# đang hiển thị, cuộn xuống cuối, trả về [scrollHeight, số link *.html]
+LOAD_MORE_JS = """
+  const BTN = /Xem thêm|Tải thêm|Load more/, LINK = /Xem thêm|Tải thêm|Trang sau|>>/;
+  document.querySelectorAll('button, a').forEach(b => {
+    const re = b.tagName === 'BUTTON' ? BTN : LINK;
+    if (!re.test(b.textContent || '') || b.disabled || !b.offsetParent) return;
+    try { b.click(); } catch (e) {}
+  });
+  window.scrollTo(0, document.body.scrollHeight);
+  return [document.body.scrollHeight, document.querySelectorAll('a[href$=".html"]').length];
+"""
+
 def _apply_chrome_common(opts):
     if HEADLESS:
         opts.add_argument("--headless=new")
@@ -57,17 +115,31 @@ def _apply_chrome_common(opts):
     opts.add_argument("--disable-gpu")
     opts.add_argument("--window-size=1366,4000")
     opts.add_argument("--lang=vi-VN,vi")
-    opts.add_argument("--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                      "AppleWebKit/537.36 (KHTML, like Gecko) "
-                      "Chrome/127.0.0.0 Safari/537.36")
+    opts.add_argument(f"--user-agent={UA}")
     opts.add_experimental_option("excludeSwitches", ["enable-automation"])
     opts.add_experimental_option("useAutomationExtension", False)
+    # chỉ cần <a href> → không tải ảnh / thông báo (CSS chặn qua CDP, xem _block_css)
+    opts.add_experimental_option("prefs", {
+        "profile.managed_default_content_settings.images": 2,
+        "profile.default_content_setting_values.notifications": 2,
+    })
+
+def _block_css(driver):
+    # Chrome không có content setting cho stylesheet → chặn URL .css bằng CDP
+    try:
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": ["*.css", "*.css?*"]})
+    except Exception:
+        pass
 
 def _apply_firefox_common(opts):
     if HEADLESS:
         opts.add_argument("-headless")
     # user-agent mặc định của Firefox là đủ
     # có thể thêm prefs nếu bị chặn
+    # chỉ cần <a href> → không tải ảnh / CSS
+    opts.set_preference("permissions.default.image", 2)
+    opts.set_preference("permissions.default.stylesheet", 2)
 
 def make_chrome():
     # 1) undetected-chromedriver nếu có và được bật
@@ -77,6 +149,7 @@ def make_chrome():
         _apply_chrome_common(options)
         options.add_argument("--disable-blink-features=AutomationControlled")
         driver = uc.Chrome(options=options)
+        _block_css(driver)
         return driver
 
     # 2) Chrome chuẩn (webdriver-manager) — KHÔNG set user-data-dir
@@ -86,6 +159,7 @@ def make_chrome():
     _apply_chrome_common(options)
     service = ChromeService(ChromeDriverManager().install())
     driver = webdriver.Chrome(service=service, options=options)
+    _block_css(driver)
     try:
         driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {
             "source": "Object.defineProperty(navigator, 'webdriver', {get: () => undefined});"
@@ -116,93 +190,125 @@ def click_cookie_banner(driver):
         except Exception:
             continue
 
-def smart_load(driver, rounds=22, pause=1.0):
-    last_count = 0
-    last_height = 0
+def page_metrics(driver) -> Tuple[int, int]:
+    return tuple(driver.execute_script(
+        "return [document.body.scrollHeight, document.querySelectorAll('a[href$=\".html\"]').length];"
+    ))
+
+def smart_load(driver, rounds=22, pause=2.0):
+    """Cuộn/click “xem thêm” tới khi DOM ngừng lớn lên.
+
+    Mỗi vòng chờ tối đa `pause` giây (poll 100 ms) cho chiều cao trang hoặc
+    số link *.html thay đổi; hết hạn mà không đổi → dừng luôn.
+    """
+    last = (0, 0)
     for _ in range(rounds):
-        # click “Xem thêm/Tải thêm/Load more/Trang sau/>>”
         try:
-            btns = driver.find_elements(
-                By.XPATH,
-                "//button[contains(., 'Xem thêm') or contains(., 'Tải thêm') or contains(., 'Load more')]"
-                " | //a[contains(., 'Xem thêm') or contains(., 'Tải thêm') or contains(., 'Trang sau') or contains(., '>>')]"
-            )
-            for b in btns:
-                try:
-                    if b.is_enabled() and b.is_displayed():
-                        b.click()
-                        time.sleep(pause)
-                except Exception:
-                    continue
+            m = tuple(driver.execute_script(LOAD_MORE_JS))
         except Exception:
-            pass
-
-        driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-        time.sleep(pause)
+            break
+        if m != last:
+            # DOM đã lớn ngay sau click/cuộn → sang vòng sau, khỏi chờ
+            last = m
+            continue
 
         try:
-            new_height = driver.execute_script("return document.body.scrollHeight")
-            links_count = driver.execute_script("return document.querySelectorAll('a[href$=\".html\"]').length")
+            last = WebDriverWait(driver, pause, poll_frequency=0.1).until(
+                lambda d: (m := page_metrics(d)) != last and m
+            )
         except Exception:
-            new_height, links_count = 0, 0
-
-        if new_height == last_height and links_count == last_count:
+            # TimeoutException: DOM không lớn thêm; còn lại: lỗi script/driver
             break
-        last_height = new_height
-        last_count  = links_count
 
-def collect_links_js(driver, focus: str, max_items: int) -> List[Tuple[str, str]]:
-    raw = driver.execute_script("""
-      return Array.from(document.querySelectorAll('a[href$=".html"]')).map(a => {
-        return [a.href, (a.title || a.textContent || '').trim()];
-      });
-    """)
+def filter_links(raw, focus: str, max_items: int) -> List[Tuple[str, str]]:
     seen, out = set(), []
-    domain = "https://kinhtedothi.vn"
     for href, text in raw:
-        if not href.startswith(domain):
+        if not href.startswith(DOMAIN):
             continue
         href_l = href.lower()
         if focus and focus not in href_l:
             # nếu lọc quá chặt, vẫn chấp nhận link dạng ...12345.html
-            if not re.search(r"\\d+\\.html$", href_l):
+            if not _DIGIT_HTML.search(href_l):
                 continue
         if href in seen:
             continue
         seen.add(href)
         if not text:
             text = href.rsplit("/", 1)[-1].replace("-", " ").strip()
-        text = re.sub(r"\\s+", " ", text)
+        text = _WS.sub(" ", text)
         out.append((href, text))
         if len(out) >= max_items:
             break
     return out
 
-def build_rss(items: List[Tuple[str,str]], channel_link: str) -> str:
+def collect_links_js(driver, focus: str, max_items: int) -> List[Tuple[str, str]]:
+    # lọc + cắt max_items ngay trong trình duyệt → chỉ trả về ≤ max_items cặp
+    raw = driver.execute_script(COLLECT_LINKS_JS, focus, max_items, DOMAIN)
+    return [(href, text) for href, text in raw]
+
+def collect_links_static(html_text: str, base: str, focus: str, max_items: int) -> List[Tuple[str, str]]:
+    tree = LexborHTMLParser(html_text)
+    raw = []
+    for a in tree.css(ARTICLE_CSS):
+        href = urllib.parse.urljoin(base, (a.attributes.get("href") or "").strip())
+        text = (a.attributes.get("title") or a.text() or "").strip()
+        raw.append((href, text))
+    return filter_links(raw, focus, max_items)
+
+def fetch_static_links() -> List[Tuple[str, str]]:
+    try:
+        r = SESSION.get(URL, timeout=25)
+        r.raise_for_status()
+    except Exception as e:
+        print("[!] Tải HTML tĩnh lỗi → dùng trình duyệt. Lý do:", e)
+        return []
+    return collect_links_static(r.text, r.url, FOCUS_SUB, MAX_ITEMS)
+
+def build_rss(items: List[Tuple[str,str]], channel_link: str) -> Iterator[str]:
+    """Sinh từng dòng XML của feed (escape bằng xml.sax.saxutils)."""
     now = datetime.now(timezone.utc).strftime("%a, %d %b %Y %H:%M:%S %z")
-    parts = [
-        '<?xml version="1.0" encoding="UTF-8"?>',
-        '<rss version="2.0">',
-        '<channel>',
-        f'<title>Kinh tế & Đô thị — Pseudo feed</title>',
-        f'<link>{html.escape(channel_link)}</link>',
-        '<description>Feed giả lập trích từ chuyên mục Kinh tế & Đô thị</description>',
-        f'<pubDate>{now}</pubDate>',
-    ]
+    yield '<?xml version="1.0" encoding="UTF-8"?>'
+    yield '<rss version="2.0">'
+    yield '<channel>'
+    yield f'<title>{escape("Kinh tế & Đô thị — Pseudo feed")}</title>'
+    yield f'<link>{escape(channel_link)}</link>'
+    yield f'<description>{escape("Feed giả lập trích từ chuyên mục Kinh tế & Đô thị")}</description>'
+    yield f'<pubDate>{now}</pubDate>'
     for href, title in items:
-        parts += [
-            "<item>",
-            f"<title>{html.escape(title or 'Bài viết')}</title>",
-            f"<link>{html.escape(href)}</link>",
-            f"<pubDate>{now}</pubDate>",
-            "</item>"
-        ]
-    parts += ["</channel></rss>"]
-    return "\n".join(parts)
+        yield "<item>"
+        yield f"<title>{escape(title or 'Bài viết')}</title>"
+        yield f"<link>{escape(href)}</link>"
+        yield f"<pubDate>{now}</pubDate>"
+        yield "</item>"
+    yield "</channel></rss>"
+
+def write_debug_links(links: List[Tuple[str, str]]):
+    with open("debug_links.txt", "w", encoding="utf-8") as f:
+        for href, title in links:
+            f.write(f"{title} | {href}\n")
+
+def write_feed(links: List[Tuple[str, str]]):
+    with open(OUT_FILE, "w", encoding="utf-8") as f:
+        for line in build_rss(links, URL):
+            f.write(line + "\n")
+
+    print(f"✅ Lấy {len(links)} bài. Ghi -> {OUT_FILE}")
+    for i, (href, title) in enumerate(links[:5], 1):
+        print(f"  {i}. {title}\n     {href}")
 
 def main():
     print(f"[i] URL: {URL}")
     print(f"[i] Headless: {HEADLESS} | Focus: {FOCUS_SUB or '(none)'}")
+
+    # Fast path: HTML tĩnh (SSR) đã đủ link thì không cần mở trình duyệt
+    links = fetch_static_links()
+    if links and len(links) >= max(1, MAX_ITEMS // 2):
+        print(f"[i] HTML tĩnh có {len(links)} link → bỏ qua Selenium")
+        write_debug_links(links)
+        write_feed(links)
+        return
+    print(f"[i] HTML tĩnh chỉ có {len(links)} link → dùng Selenium")
+
     driver = None
     tried_firefox = False
     try:
@@ -219,17 +325,15 @@ def main():
         click_cookie_banner(driver)
 
         try:
-            WebDriverWait(driver, 12).until(EC.presence_of_element_located((By.CSS_SELECTOR, "a[href$='.html']")))
+            WebDriverWait(driver, 12).until(EC.presence_of_element_located((By.CSS_SELECTOR, ARTICLE_CSS)))
         except Exception:
             pass
 
-        smart_load(driver, rounds=22, pause=1.0)
+        smart_load(driver, rounds=22, pause=2.0)
         links = collect_links_js(driver, FOCUS_SUB, MAX_ITEMS)
 
         # ghi debug
-        with open("debug_links.txt", "w", encoding="utf-8") as f:
-            for href, title in links:
-                f.write(f"{title} | {href}\n")
+        write_debug_links(links)
 
         if not links:
             with open("debug_page.html", "w", encoding="utf-8") as f:
@@ -238,13 +342,7 @@ def main():
             print("Gợi ý: set KINHTEDOTHI_HEADLESS=0, xoá KINHTEDOTHI_FOCUS, tăng rounds; hoặc thử Firefox/Chrome ngược lại.")
             return
 
-        xml = build_rss(links, URL)
-        with open(OUT_FILE, "w", encoding="utf-8") as f:
-            f.write(xml)
-
-        print(f"✅ Lấy {len(links)} bài. Ghi -> {OUT_FILE}")
-        for i, (href, title) in enumerate(links[:5], 1):
-            print(f"  {i}. {title}\n     {href}")
+        write_feed(links)
 
     finally:
         if driver:
@@ -6,145 +6,319 @@ RSS Watcher - deduplicate by persistent state (no more resending old items)
 - Reads feeds from an OPML file (xmlUrl entries) - local pseudo-feed XML also OK
 - Loads keyword rules from a TXT file (one rule per line, supports AND/OR)
 - Sends email instantly when NEW items match (no duplicates across workflow runs)
-- Persists 'seen' IDs per feed to a JSON file so next runs won't resend
+- Persists 'seen' (feed, entry id) pairs in a scalable Bloom filter so next runs won't resend
 
 ENV (set via GitHub Actions env/secrets or local):
-  STATE_FILE               default: .state/seen.json
-  STATE_TTL_DAYS           default: 30
-  STATE_MAX_IDS_PER_FEED   default: 2000
+  STATE_FILE               default: .state/watcher.json # run metadata (last_run); legacy 'seen' ids are imported once
+                                                        # (not .state/seen.json: that is rss_watcher_fast.py's state)
+  LEGACY_STATE_FILE        default: .state/seen.json    # old shared state; read (never written) on the first run,
+                                                        # when neither STATE_FILE nor BLOOM_FILE exists yet
+  BLOOM_FILE               default: .state/bloom.bin    # seen (feed, id) Bloom filter
+  BLOOM_CAPACITY           default: 2000  # ids in the first filter; later filters double in size
+  BLOOM_ERROR_RATE         default: 1e-4  # overall false-positive bound (a false positive = item not emailed)
+  CACHE_FILE               default: .state/watcher_cache.json  # ETag/Last-Modified per feed (conditional GET); kept apart from
+                                                               # rss_watcher_fast.py's .state/cache.json, whose 304s would hide unseen items
+  STATE_PRETTY             default: 0   # set to 1 to indent the JSON state/cache files (human-readable diffs)
   STATE_INIT_IF_EMPTY      default: 0   # set to 1 for the very first run to record current items as seen without emailing
+  FETCH_WORKERS            default: 16  # max feeds fetched/parsed in parallel
+  REQ_TIMEOUT              default: 25  # seconds per feed request
 
   SMTP_HOST, SMTP_PORT, SMTP_USER, SMTP_PASS, SMTP_FROM, SMTP_TO  (email settings)
+  EMAIL_PER_FEED           default: 0   # set to 1 to send one email per feed (over a single SMTP session) instead of one digest
   DRY_RUN                  default: 0   # set to 1 to skip sending email
 
 Usage:
   python rss_watcher.py feeds.opml keywords.txt
 """
-import os, re, json, time, html, sys, hashlib
+import os, re, json, time, html, sys, hashlib, math, struct
+from bisect import bisect_right
+from itertools import chain
 from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 from datetime import datetime, timedelta, timezone
 from typing import List, Dict, Tuple
+from concurrent.futures import ThreadPoolExecutor
 
 import feedparser
-from bs4 import BeautifulSoup
 import requests
+from lxml import etree, html as lxml_html
+
+try:
+    import ahocorasick
+except Exception:  # optional: matching falls back to plain substring checks
+    ahocorasick = None
+
+try:
+    import orjson
+except Exception:  # optional: state/cache I/O falls back to stdlib json
+    orjson = None
+
+try:
+    import xxhash
+except Exception:  # optional: entry-id fingerprints fall back to sha1
+    xxhash = None
+
+# Feed HTML is only ever reduced to text and re-escaped (entry_summary), never rendered,
+# so feedparser's sanitizer and relative-URI rewriting are pure overhead.
+feedparser.SANITIZE_HTML = False
+feedparser.RESOLVE_RELATIVE_URIS = False
 
 # ---------- Email (SMTP) ----------
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
-def send_email(subject: str, html_body: str):
-    host = os.environ.get('SMTP_HOST', 'smtp.gmail.com')
-    port = int(os.environ.get('SMTP_PORT', '465'))
-    user = os.environ.get('SMTP_USER')
-    password = os.environ.get('SMTP_PASS')
-    from_addr = os.environ.get('SMTP_FROM', user)
-    to_addrs = [x.strip() for x in os.environ.get('SMTP_TO', '').split(',') if x.strip()]
-
-    if not (user and password and to_addrs):
-        print("Warning: SMTP env not set - skipping email. (Need SMTP_USER/SMTP_PASS/SMTP_TO)")
-        return
-
-    msg = MIMEMultipart()
-    msg['From'] = from_addr
-    msg['To'] = ', '.join(to_addrs)
-    msg['Subject'] = subject
-    msg.attach(MIMEText(html_body, 'html', 'utf-8'))
+class SmtpSender:
+    """
+    One SMTP session per run: the connection (TLS + AUTH) is opened lazily on the
+    first send() and reused for every following message, then closed on exit.
+    """
 
-    if os.environ.get('DRY_RUN') == '1':
-        print("DRY_RUN=1 -> not sending email. Subject:", subject)
-        return
+    def __init__(self):
+        self.host = os.environ.get('SMTP_HOST', 'smtp.gmail.com')
+        self.port = int(os.environ.get('SMTP_PORT', '465'))
+        self.user = os.environ.get('SMTP_USER')
+        self.password = os.environ.get('SMTP_PASS')
+        self.from_addr = os.environ.get('SMTP_FROM', self.user)
+        self.to_addrs = [x.strip() for x in os.environ.get('SMTP_TO', '').split(',') if x.strip()]
+        self.dry_run = os.environ.get('DRY_RUN') == '1'
+        self.smtp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except smtplib.SMTPException:
+                self.smtp.close()
+            self.smtp = None
 
-    try:
-        if port == 465:
-            with smtplib.SMTP_SSL(host, port) as smtp:
-                smtp.login(user, password)
-                smtp.send_message(msg)
-        else:
-            with smtplib.SMTP(host, port) as smtp:
+    def _connect(self):
+        try:
+            if self.port == 465:
+                smtp = smtplib.SMTP_SSL(self.host, self.port)
+            else:
+                smtp = smtplib.SMTP(self.host, self.port)
                 smtp.ehlo()
                 smtp.starttls()
-                smtp.login(user, password)
-                smtp.send_message(msg)
-        print("Email sent to:", ', '.join(to_addrs))
-    except smtplib.SMTPAuthenticationError as e:
-        print("SMTPAuthenticationError:", e)
-        print("-> Gmail users: enable 2FA and generate an App Password.")
-        raise
+            smtp.login(self.user, self.password)
+        except smtplib.SMTPAuthenticationError as e:
+            print("SMTPAuthenticationError:", e)
+            print("-> Gmail users: enable 2FA and generate an App Password.")
+            raise
+        self.smtp = smtp
+
+    def send(self, subject: str, html_body: str):
+        if not (self.user and self.password and self.to_addrs):
+            print("Warning: SMTP env not set - skipping email. (Need SMTP_USER/SMTP_PASS/SMTP_TO)")
+            return
+
+        msg = MIMEMultipart()
+        msg['From'] = self.from_addr
+        msg['To'] = ', '.join(self.to_addrs)
+        msg['Subject'] = subject
+        msg.attach(MIMEText(html_body, 'html', 'utf-8'))
+
+        if self.dry_run:
+            print("DRY_RUN=1 -> not sending email. Subject:", subject)
+            return
+
+        if self.smtp is None:
+            self._connect()
+        self.smtp.send_message(msg)
+        print("Email sent to:", ', '.join(self.to_addrs))
 
 # ---------- State persistence ----------
 
-STATE_FILE = Path(os.environ.get("STATE_FILE", ".state/seen.json"))
-STATE_TTL_DAYS = int(os.environ.get("STATE_TTL_DAYS", "30"))
-STATE_MAX_IDS_PER_FEED = int(os.environ.get("STATE_MAX_IDS_PER_FEED", "2000"))
+STATE_FILE = Path(os.environ.get("STATE_FILE", ".state/watcher.json"))
+BLOOM_FILE = Path(os.environ.get("BLOOM_FILE", ".state/bloom.bin"))
+LEGACY_STATE_FILE = Path(os.environ.get("LEGACY_STATE_FILE", ".state/seen.json"))
+BLOOM_CAPACITY = int(os.environ.get("BLOOM_CAPACITY", "2000"))
+BLOOM_ERROR_RATE = float(os.environ.get("BLOOM_ERROR_RATE", "1e-4"))
 STATE_INIT_IF_EMPTY = os.environ.get("STATE_INIT_IF_EMPTY", "0") == "1"
+CACHE_FILE = Path(os.environ.get("CACHE_FILE", ".state/watcher_cache.json"))
+STATE_PRETTY = os.environ.get("STATE_PRETTY", "0") == "1"
+EMAIL_PER_FEED = os.environ.get("EMAIL_PER_FEED", "0") == "1"
 
 def _now_ts() -> int:
     return int(time.time())
 
-def load_state() -> Dict:
-    if STATE_FILE.exists():
+def load_json(p: Path, fallback):
+    if p.exists():
         try:
-            return json.loads(STATE_FILE.read_text(encoding="utf-8"))
+            data = p.read_bytes()
+            return orjson.loads(data) if orjson is not None else json.loads(data.decode("utf-8"))
         except Exception:
             pass
-    return {"seen": {}, "last_run": 0}
+    return fallback
+
+def save_json(p: Path, data):
+    p.parent.mkdir(parents=True, exist_ok=True)
+    if orjson is not None:
+        opt = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if STATE_PRETTY else 0)
+        p.write_bytes(orjson.dumps(data, option=opt))
+    else:
+        text = json.dumps(data, ensure_ascii=False, indent=2) if STATE_PRETTY else \
+            json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+        p.write_text(text, encoding="utf-8")
+
+class BloomFilter:
+    """Fixed-size Bloom filter; k bit positions come from one blake2b digest (double hashing)."""
+
+    def __init__(self, capacity: int, error_rate: float, count: int = 0, bits: bytearray = None):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.count = count
+        self.m = max(8, math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.k = max(1, round(self.m / capacity * math.log(2)))
+        self.bits = bits if bits is not None else bytearray((self.m + 7) // 8)
+
+    def _positions(self, key: str):
+        h = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(h[:8], "little")
+        h2 = int.from_bytes(h[8:], "little") | 1
+        return [(h1 + i * h2) % self.m for i in range(self.k)]
+
+    def __contains__(self, key: str) -> bool:
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def add(self, key: str):
+        for p in self._positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+class ScalableBloomFilter:
+    """
+    Chain of BloomFilters. When the newest one reaches its capacity, a new filter with
+    2x capacity and half the error rate is appended, so the overall false-positive rate
+    stays below `error_rate` no matter how many ids are added.
+    """
+    _MAGIC = b"SBF1"
+    _HEAD = struct.Struct("<4sQdI")       # magic, initial_capacity, error_rate, n_filters
+    _FILTER = struct.Struct("<QdQQ")      # capacity, error_rate, count, n_bytes
+
+    def __init__(self, initial_capacity: int, error_rate: float):
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.filters: List[BloomFilter] = []
+
+    def __contains__(self, key: str) -> bool:
+        return any(key in f for f in self.filters)
+
+    def __len__(self) -> int:
+        return sum(f.count for f in self.filters)
+
+    def add(self, key: str):
+        if key in self:
+            return
+        if not self.filters or self.filters[-1].count >= self.filters[-1].capacity:
+            n = len(self.filters)
+            self.filters.append(BloomFilter(self.initial_capacity * 2 ** n, self.error_rate * 0.5 ** (n + 1)))
+        self.filters[-1].add(key)
+
+    def tofile(self, path: Path):
+        with path.open("wb") as fh:
+            fh.write(self._HEAD.pack(self._MAGIC, self.initial_capacity, self.error_rate, len(self.filters)))
+            for f in self.filters:
+                fh.write(self._FILTER.pack(f.capacity, f.error_rate, f.count, len(f.bits)))
+                fh.write(f.bits)
+
+    @classmethod
+    def fromfile(cls, path: Path) -> "ScalableBloomFilter":
+        data = path.read_bytes()
+        magic, cap, err, n = cls._HEAD.unpack_from(data, 0)
+        if magic != cls._MAGIC:
+            raise ValueError(f"{path}: not a Bloom filter file")
+        sbf = cls(cap, err)
+        off = cls._HEAD.size
+        for _ in range(n):
+            fcap, ferr, count, nbytes = cls._FILTER.unpack_from(data, off)
+            off += cls._FILTER.size
+            sbf.filters.append(BloomFilter(fcap, ferr, count, bytearray(data[off:off + nbytes])))
+            off += nbytes
+        return sbf
+
+def seen_key(feed_url: str, entry_id: str) -> str:
+    return f"{feed_url}\t{entry_id}"
+
+def load_state() -> Dict:
+    state = {"last_run": 0}
+    if STATE_FILE.exists():
+        state.update(load_json(STATE_FILE, {}))
+    elif not BLOOM_FILE.exists() and LEGACY_STATE_FILE.exists():
+        # first run since STATE_FILE moved off .state/seen.json: import the old ids (read-only)
+        legacy_state = load_json(LEGACY_STATE_FILE, {})
+        if isinstance(legacy_state, dict):
+            state["last_run"] = legacy_state.get("last_run", 0)
+            state["seen"] = legacy_state.get("seen")
+    bloom = None
+    if BLOOM_FILE.exists():
+        try:
+            bloom = ScalableBloomFilter.fromfile(BLOOM_FILE)
+        except Exception as e:
+            print("Bloom state unreadable, starting empty:", e)
+    if bloom is None:
+        bloom = ScalableBloomFilter(BLOOM_CAPACITY, BLOOM_ERROR_RATE)
+    # one-time migration of the old per-feed JSON {feed: {id: ts}},
+    # or of a rss_watcher_fast.py snapshot [[ts, id, feed], ...]
+    legacy = state.pop("seen", None) or {}
+    if isinstance(legacy, dict):
+        for feed_url, items in legacy.items():
+            for _id in items:
+                bloom.add(seen_key(feed_url, _id))
+    else:
+        for _ts, _id, feed_url in legacy:
+            bloom.add(seen_key(feed_url, _id))
+    state["bloom"] = bloom
+    return state
 
 def save_state(state: Dict):
-    STATE_FILE.parent.mkdir(parents=True, exist_ok=True)
-    STATE_FILE.write_text(json.dumps(state, ensure_ascii=False, indent=2), encoding="utf-8")
-
-def prune_state(state: Dict):
-    cutoff = _now_ts() - STATE_TTL_DAYS * 86400
-    seen = state.get("seen", {})
-    for feed_url, items in list(seen.items()):
-        # remove too old
-        new_items = {k: v for k, v in items.items() if v >= cutoff}
-        # size cap
-        if len(new_items) > STATE_MAX_IDS_PER_FEED:
-            # keep newest N
-            new_items = dict(sorted(new_items.items(), key=lambda kv: kv[1], reverse=True)[:STATE_MAX_IDS_PER_FEED])
-        seen[feed_url] = new_items
-    state["seen"] = seen
+    BLOOM_FILE.parent.mkdir(parents=True, exist_ok=True)
+    state["bloom"].tofile(BLOOM_FILE)
+    save_json(STATE_FILE, {k: v for k, v in state.items() if k != "bloom"})
+
+def load_cache() -> Dict:
+    return load_json(CACHE_FILE, {})
+
+def save_cache(cache: Dict):
+    save_json(CACHE_FILE, cache)
 
 # ---------- Input parsing ----------
 
+_TRACKING_PARAMS = ("utm_", "fbclid", "gclid")
+
+def _feed_url_key(u: str) -> str:
+    """Dedup key for a feed URL: lowercase scheme/host, no trailing slash, fragment or tracking params."""
+    p = urlsplit(u)
+    q = [(k, v) for k, v in parse_qsl(p.query, keep_blank_values=True) if not k.lower().startswith(_TRACKING_PARAMS)]
+    return urlunsplit((p.scheme.lower(), p.netloc.lower(), p.path.rstrip("/"), urlencode(q), ""))
+
 def parse_opml(opml_path: Path) -> List[str]:
-    import xml.etree.ElementTree as ET
-    urls = []
+    """
+    Stream <outline xmlUrl=...> entries with lxml iterparse; de-dup on a normalized
+    URL key while preserving order (the first spelling of each feed is the one fetched).
+    """
+    seen = set()
+    out = []
     try:
-        tree = ET.parse(opml_path)
+        for _, el in etree.iterparse(str(opml_path), events=("end",), tag="{*}outline"):
+            u = (el.get("xmlUrl") or el.get("xmlurl") or "").strip()
+            key = _feed_url_key(u) if u else ""
+            if key and key not in seen:
+                out.append(u)
+                seen.add(key)
+            el.clear()
     except Exception as e:
         print("OPML parse error:", e)
-        return urls
-    root = tree.getroot()
-    body = root.find("body")
-    if body is None:
-        return urls
-
-    def walk(e):
-        for c in e:
-            if c.tag.lower().endswith("outline"):
-                xml = c.attrib.get("xmlUrl") or c.attrib.get("xmlurl") or ""
-                if xml:
-                    urls.append(xml.strip())
-                if list(c):
-                    yield from walk(c)
-
-    for _ in walk(body):
-        pass
-    # de-dup while preserving order
-    seen = set()
-    out = []
-    for u in urls:
-        if u and u not in seen:
-            out.append(u)
-            seen.add(u)
     return out
 
 # ---------- Keyword logic ----------
 
+_RULE_TOKEN_RE = re.compile(r'"[^"]+"|\S+', re.UNICODE)
+
 def parse_rules(lines: List[str]) -> List[List[List[str]]]:
     """
     Very simple Boolean:
@@ -159,7 +333,7 @@ def parse_rules(lines: List[str]) -> List[List[List[str]]]:
         s = raw.strip()
         if not s or s.startswith("#"):
             continue
-        parts = re.findall(r'"[^"]+"|\S+', s, flags=re.UNICODE)
+        parts = _RULE_TOKEN_RE.findall(s)
         clause = []
         group = []
         i = 0
@@ -182,25 +356,156 @@ def parse_rules(lines: List[str]) -> List[List[List[str]]]:
             rules.append(clause)
     return rules
 
-def text_matches_rules(text: str, rules) -> bool:
-    if not rules:
-        return True
-    s = text.lower()
-    for clause in rules:  # clause is OR of AND-groups
-        for group in clause:
-            if all(term in s for term in group):
-                return True
-    return False
+class RuleMatcher:
+    """
+    parse_rules() output compiled once: every distinct term goes into a single
+    Aho-Corasick automaton, so each text is scanned once and the AND/OR clauses
+    are evaluated over the set of terms found.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        # OR across clauses and across groups is the same OR -> one flat list of AND-groups
+        self.groups = [tuple(group) for clause in rules for group in clause]
+        # fallback path: terms pre-encoded once, text encoded once per entry
+        self.groups_b = [tuple(t.encode("utf-8") for t in g) for g in self.groups]
+        # OR-only rules (every AND-group is a single term): one bytes alternation, C-level search with early exit
+        self.any_re = None
+        if self.groups and all(len(g) == 1 for g in self.groups_b):
+            alts = sorted({g[0] for g in self.groups_b}, key=len, reverse=True)
+            self.any_re = re.compile(b"|".join(re.escape(t) for t in alts))
+        self.automaton = None
+        terms = {t for group in self.groups for t in group if t}
+        if ahocorasick is not None and terms:
+            automaton = ahocorasick.Automaton()
+            for t in terms:
+                automaton.add_word(t, t)
+            automaton.make_automaton()
+            self.automaton = automaton
+
+    def matches(self, text: str) -> bool:
+        if not self.rules:
+            return True
+        s = text.lower()
+        if self.any_re is not None:
+            return self.any_re.search(s.encode("utf-8")) is not None
+        if self.automaton is None:
+            sb = s.encode("utf-8")
+            return any(all(term in sb for term in group) for group in self.groups_b)
+        hits = {t for _, t in self.automaton.iter(s)}
+        hits.add("")  # empty term ('""') matches everything, as with `"" in s`
+        return any(all(term in hits for term in group) for group in self.groups)
+
+    def matches_many(self, texts: List[str]) -> List[bool]:
+        """
+        Batch form of matches(): all texts are lowered, joined with NUL and scanned by the
+        automaton in a single C-level pass; each hit is mapped back to its text by offset.
+        """
+        if not self.rules:
+            return [True] * len(texts)
+        if self.any_re is not None:
+            search = self.any_re.search
+            return [search(t.lower().encode("utf-8")) is not None for t in texts]
+        if self.automaton is None or not texts:
+            return [self.matches(t) for t in texts]
+        lowered = [t.lower() for t in texts]
+        starts = []
+        pos = 0
+        for t in lowered:
+            starts.append(pos)
+            pos += len(t) + 1
+        hits = [{""} for _ in lowered]  # empty term always matches
+        for end, term in self.automaton.iter("\0".join(lowered)):
+            hits[bisect_right(starts, end) - 1].add(term)
+        return [any(all(term in h for term in group) for group in self.groups) for h in hits]
 
 # ---------- Feed processing ----------
 
+FETCH_WORKERS = int(os.environ.get("FETCH_WORKERS", "16"))
+REQ_TIMEOUT = int(os.environ.get("REQ_TIMEOUT", "25"))
+USER_AGENT = "Mozilla/5.0 RSS-Watcher"
+
+def _parse_feed(url: str, cache: Dict):
+    """
+    Conditional GET (If-None-Match / If-Modified-Since from cache), then feedparser.
+    Returns None on HTTP 304 or on failure. Non-HTTP sources (local pseudo-feed XML)
+    go straight to feedparser.
+    """
+    if not url.lower().startswith(("http://", "https://")):
+        try:
+            return feedparser.parse(url)
+        except Exception as e:
+            print("feedparser error:", url, e)
+            return None
+
+    meta = cache.get(url, {})
+    headers = {"User-Agent": USER_AGENT}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    try:
+        resp = requests.get(url, headers=headers, timeout=REQ_TIMEOUT)
+        if resp.status_code == 304:
+            cache[url] = {**meta, "fetched_at": _now_ts(), "status": 304}
+            return None
+        resp.raise_for_status()
+        d = feedparser.parse(resp.content)
+    except Exception as e:
+        print("feed fetch error:", url, e)
+        cache[url] = {**meta, "error": str(e), "fetched_at": _now_ts()}
+        return None
+    cache[url] = {
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+        "fetched_at": _now_ts(),
+        "status": resp.status_code,
+    }
+    return d
+
+def parse_feeds(feeds: List[str], cache: Dict) -> list:
+    """Fetch + parse all feeds in a thread pool (network-bound). Results keep feed order; None on 304/failure."""
+    if not feeds:
+        return []
+    with ThreadPoolExecutor(max_workers=min(FETCH_WORKERS, len(feeds))) as ex:
+        return list(ex.map(lambda f: _parse_feed(f, cache), feeds))
+
 def norm_id(entry) -> str:
     for key in ("id", "guid", "link"):
         if entry.get(key):
             return entry.get(key)
-    combo = (entry.get("title", "") + "|" + entry.get("link", "") + "|" + str(entry.get("published", ""))).encode("utf-8", "ignore")
+    combo = _id_combo(entry)
+    if xxhash is not None:
+        # dedup only, not a security boundary: a fast non-cryptographic hash is enough
+        return "h:" + xxhash.xxh3_64_hexdigest(combo)
     return "h:" + hashlib.sha1(combo).hexdigest()
 
+def _id_combo(entry) -> bytes:
+    return (entry.get("title", "") + "|" + entry.get("link", "") + "|" + str(entry.get("published", ""))).encode("utf-8", "ignore")
+
+def legacy_id(entry, _id: str):
+    """The pre-xxhash sha1 id for an xxh3-hashed entry (so ids stored by older runs still match), else None."""
+    if len(_id) == 18 and _id.startswith("h:"):
+        return "h:" + hashlib.sha1(_id_combo(entry)).hexdigest()
+    return None
+
+_TAG_RE = re.compile(r"<[^>]+>")
+
+def summary_text(desc: str) -> str:
+    """Plain text of an entry summary/description: tags, script/style bodies and attributes dropped, entities decoded."""
+    if not desc:
+        return ""
+    if "<" not in desc:
+        # plain-text summary: no HTML parse needed, only entity decoding
+        return html.unescape(desc).strip()
+    try:
+        frag = lxml_html.fragment_fromstring(desc, create_parent=True)
+        etree.strip_elements(frag, "script", "style", with_tail=False)  # feedparser no longer sanitizes: drop script/style bodies ourselves
+        text = " ".join(frag.itertext())
+    except Exception:  # malformed fragment: crude tag strip
+        text = html.unescape(_TAG_RE.sub(" ", desc))
+    return " ".join(text.split())
+
 def entry_summary(entry) -> str:
     parts = []
     if entry.get("title"):
@@ -209,58 +514,66 @@ def entry_summary(entry) -> str:
         parts.append(f"<i>{html.escape(entry.published)}</i>")
     if entry.get("link"):
         parts.append(f'<div><a href="{html.escape(entry.link)}">{html.escape(entry.link)}</a></div>')
-    desc = entry.get("summary") or entry.get("description") or ""
-    if desc:
-        from bs4 import BeautifulSoup
-        clean = BeautifulSoup(desc, "lxml").get_text(" ", strip=True)
+    clean = summary_text(entry.get("summary") or entry.get("description") or "")
+    if clean:
         if len(clean) > 500:
             clean = clean[:500] + "…"
         parts.append(f"<div>{html.escape(clean)}</div>")
     return "<br/>".join(parts)
 
-def process(feeds: List[str], rules, state: Dict) -> tuple[int, str]:
-    seen = state.setdefault("seen", {})
-    now_ts = _now_ts()
+def process(feeds: List[str], rules, state: Dict, cache: Dict) -> tuple[int, List[Tuple[str, str]]]:
+    """Returns (number of new matching items, [(subject, html_body), ...] to send)."""
+    bloom = state["bloom"]
     hits = []
 
-    for f in feeds:
-        try:
-            d = feedparser.parse(f)
-        except Exception as e:
-            print("feedparser error:", f, e)
-            continue
+    for f, d in zip(feeds, parse_feeds(feeds, cache)):
         if not d or not d.get("entries"):
             continue
-        feed_seen = seen.setdefault(f, {})
+        fresh, fresh_keys = [], set()
         for e in d.entries:
             _id = norm_id(e)
-            if _id in feed_seen:
-                continue  # already sent before
-            title = e.get("title") or ""
-            desc  = e.get("summary") or e.get("description") or ""
-            combined = f"{title}\n{desc}"
-            if text_matches_rules(combined, rules):
+            key = seen_key(f, _id)
+            if key in bloom or key in fresh_keys:
+                continue  # already sent before (or repeated within this feed)
+            old_id = legacy_id(e, _id)
+            if old_id is not None and seen_key(f, old_id) in bloom:
+                continue
+            fresh.append((e, _id, key))
+            fresh_keys.add(key)
+        # one matcher call per feed instead of one per entry
+        texts = [f"{e.get('title') or ''}\n{summary_text(e.get('summary') or e.get('description') or '')}" for e, _, _ in fresh]
+        for (e, _id, key), matched in zip(fresh, rules.matches_many(texts)):
+            if matched:
                 hits.append((f, e, _id))
-                feed_seen[_id] = now_ts  # mark seen immediately
+                bloom.add(key)  # mark seen immediately
 
-    if not hits:
-        return 0, ""
+    return len(hits), build_messages(feeds, hits)
 
-    from collections import defaultdict
-    groups = defaultdict(list)
+def build_messages(feeds: List[str], hits: list) -> List[Tuple[str, str]]:
+    """One digest email for all hits, or one email per feed with EMAIL_PER_FEED=1."""
+    if not hits:
+        return []
+    if not EMAIL_PER_FEED:
+        return [(f"[RSS Watcher] {len(hits)} bài mới khớp bộ lọc", render_email(feeds, hits))]
+    per_feed = {}
+    for hit in hits:
+        per_feed.setdefault(hit[0], []).append(hit)
+    return [(f"[RSS Watcher] {len(fh)} bài mới khớp bộ lọc — {f}", render_email([f], fh))
+            for f, fh in per_feed.items()]
+
+def render_email(feeds: List[str], hits: list) -> str:
+    """HTML body for (feed, entry, id) hits, grouped per feed in OPML order."""
+    groups = {f: [] for f in feeds}
     for f, e, _ in hits:
-        groups[f].append(e)
-
-    html_parts = ['<div style="font-family:Arial,Helvetica,sans-serif;font-size:14px">']
-    html_parts.append(f"<h2>RSS Watcher — {len(hits)} bài mới khớp bộ lọc</h2>")
-    for f, entries in groups.items():
-        html_parts.append(f'<h3 style="margin-top:16px">{html.escape(f)}</h3><ul>')
-        for e in entries:
-            html_parts.append("<li>" + entry_summary(e) + "</li>")
-        html_parts.append("</ul>")
-    html_parts.append("</div>")
-    html_body = "\n".join(html_parts)
-    return len(hits), html_body
+        groups.setdefault(f, []).append(e)
+    return "\n".join(chain(
+        ['<div style="font-family:Arial,Helvetica,sans-serif;font-size:14px">',
+         f"<h2>RSS Watcher — {len(hits)} bài mới khớp bộ lọc</h2>"],
+        (f'<h3 style="margin-top:16px">{html.escape(f)}</h3><ul>'
+         + "".join(f"<li>{entry_summary(e)}</li>" for e in entries) + "</ul>"
+         for f, entries in groups.items() if entries),
+        ["</div>"],
+    ))
 
 def main():
     if len(sys.argv) < 3:
@@ -275,39 +588,34 @@ def main():
     lines = []
     if keywords_txt.exists():
         lines = [l.rstrip("\n") for l in keywords_txt.read_text(encoding="utf-8").splitlines()]
-    rules = parse_rules(lines)
+    rules = RuleMatcher(parse_rules(lines))
 
     state = load_state()
+    cache = load_cache()
     first_time = (state.get("last_run", 0) == 0)
     if first_time and STATE_INIT_IF_EMPTY:
         print("First run with STATE_INIT_IF_EMPTY=1 -> initialize state without sending email.")
-        for f in feeds:
-            try:
-                d = feedparser.parse(f)
-                if not d or not d.get("entries"):
-                    continue
-                feed_seen = state.setdefault("seen", {}).setdefault(f, {})
-                now_ts = _now_ts()
-                for e in d.entries:
-                    _id = norm_id(e)
-                    feed_seen[_id] = now_ts
-            except Exception:
+        for f, d in zip(feeds, parse_feeds(feeds, cache)):
+            if not d or not d.get("entries"):
                 continue
+            for e in d.entries:
+                state["bloom"].add(seen_key(f, norm_id(e)))
         state["last_run"] = _now_ts()
-        prune_state(state)
         save_state(state)
+        save_cache(cache)
         print("State initialized. Next runs will only send new items.")
         sys.exit(0)
 
-    count, html_body = process(feeds, rules, state)
+    count, messages = process(feeds, rules, state, cache)
 
     state["last_run"] = _now_ts()
-    prune_state(state)
     save_state(state)
+    save_cache(cache)
 
     if count > 0:
-        subject = f"[RSS Watcher] {count} bài mới khớp bộ lọc"
-        send_email(subject, html_body)
+        with SmtpSender() as sender:
+            for subject, html_body in messages:
+                sender.send(subject, html_body)
     else:
         print("No new matching items.")
 
@@ -4,27 +4,70 @@ rss_watcher_fast.py — tải song song + cache ETag/Last-Modified, chỉ gửi
 Usage:
   python rss_watcher_fast.py feeds.opml keywords.txt
 Env:
-  MAX_CONCURRENCY=20  REQ_TIMEOUT=25  MAX_ENTRY_AGE_DAYS=7
-  STATE_FILE=.state/seen.json  CACHE_FILE=.state/cache.json
+  MAX_CONCURRENCY=20  REQ_TIMEOUT=25  MAX_ENTRY_AGE_DAYS=7  PARSE_WORKERS=<số CPU>
+  LIMIT_PER_HOST=10  (số kết nối đồng thời tối đa tới cùng 1 host)
+  MAX_FEED_BYTES=10485760  (bỏ feed có body lớn hơn, giới hạn bộ nhớ mỗi lượt tải)
+  STATE_FILE=.state/seen.json  CACHE_FILE=.state/cache.json  STATE_PRETTY=0 (1 = JSON thụt lề cho dễ đọc)
+  SEEN_LOG=.state/seen.log  (nhật ký append-only các id mới; gộp vào STATE_FILE khi log > 2× snapshot)
+  SEEN_TTL_DAYS=30  (quên id đã gửi sau N ngày; 0 = giữ mãi)
+  EMAIL_PER_FEED=0  (1 = mỗi feed 1 email, gửi chung 1 phiên SMTP, thay vì 1 email tổng hợp)
   SMTP_HOST/SMTP_PORT/SMTP_USER/SMTP_PASS/SMTP_FROM/SMTP_TO
 """
-import os, re, json, html, sys, hashlib, asyncio, time
+import os, re, json, html, sys, hashlib, asyncio, time, heapq
+from bisect import bisect_right
+from calendar import timegm
+from itertools import chain
 from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 from typing import List, Dict, Tuple
+from concurrent.futures import ProcessPoolExecutor
 
 import aiohttp
 import feedparser
-from bs4 import BeautifulSoup
+from lxml import etree, html as lxml_html
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
+try:
+    import ahocorasick
+except Exception:  # tuỳ chọn: thiếu thì so khớp substring như cũ
+    ahocorasick = None
+
+try:
+    import orjson
+except Exception:  # tuỳ chọn: thiếu thì dùng json chuẩn
+    orjson = None
+
+try:
+    import xxhash
+except Exception:  # tuỳ chọn: thiếu thì băm id bằng sha1 như cũ
+    xxhash = None
+
+# HTML trong feed chỉ bị rút thành text rồi escape lại (entry_summary), không render:
+# tắt sanitizer + resolve URI tương đối của feedparser (đặt lúc import nên process con cũng nhận)
+feedparser.SANITIZE_HTML = False
+feedparser.RESOLVE_RELATIVE_URIS = False
+
+try:
+    import brotli  # noqa: F401  (aiohttp tự giải nén "br" khi có gói này)
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except Exception:
+    ACCEPT_ENCODING = "gzip, deflate"
+
 MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", "20"))
 REQ_TIMEOUT = int(os.environ.get("REQ_TIMEOUT", "25"))
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", str(os.cpu_count() or 2)))
 MAX_ENTRY_AGE_DAYS = int(os.environ.get("MAX_ENTRY_AGE_DAYS", "7"))
+LIMIT_PER_HOST = int(os.environ.get("LIMIT_PER_HOST", "10"))
+MAX_FEED_BYTES = int(os.environ.get("MAX_FEED_BYTES", str(10 * 1024 * 1024)))
 
 STATE_FILE = Path(os.environ.get("STATE_FILE", ".state/seen.json"))
 CACHE_FILE = Path(os.environ.get("CACHE_FILE", ".state/cache.json"))
+STATE_PRETTY = os.environ.get("STATE_PRETTY", "0") == "1"
+SEEN_LOG = Path(os.environ.get("SEEN_LOG", ".state/seen.log"))
+SEEN_TTL_DAYS = int(os.environ.get("SEEN_TTL_DAYS", "30"))
+EMAIL_PER_FEED = os.environ.get("EMAIL_PER_FEED", "0") == "1"
 
 def _now_ts() -> int:
     return int(time.time())
@@ -32,46 +75,105 @@ def _now_ts() -> int:
 def load_json(p: Path, fallback):
     if p.exists():
         try:
-            return json.loads(p.read_text(encoding="utf-8"))
+            data = p.read_bytes()
+            return orjson.loads(data) if orjson is not None else json.loads(data.decode("utf-8"))
         except Exception:
             pass
     return fallback
 
 def save_json(p: Path, data):
     p.parent.mkdir(parents=True, exist_ok=True)
-    p.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    if orjson is not None:
+        opt = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if STATE_PRETTY else 0)
+        p.write_bytes(orjson.dumps(data, option=opt))
+    else:
+        text = json.dumps(data, ensure_ascii=False, indent=2) if STATE_PRETTY else \
+            json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+        p.write_text(text, encoding="utf-8")
+
+def _dumps_line(rec) -> bytes:
+    return (orjson.dumps(rec) if orjson is not None else json.dumps(rec, ensure_ascii=False).encode("utf-8")) + b"\n"
+
+def _mark_seen(state: Dict, feed: str, _id: str, ts: int):
+    if _id not in state["seen"]:
+        state["seen"].add(_id)
+        heapq.heappush(state["ttl"], (ts, _id, feed))
+
+def load_state() -> Dict:
+    """
+    Snapshot (STATE_FILE) + replay nhật ký SEEN_LOG (mỗi dòng JSON: [feed, id, ts]).
+    Trong bộ nhớ: state["seen"] = set id (tra cứu O(1)), state["ttl"] = min-heap (ts, id, feed) để hết hạn.
+    """
+    state = load_json(STATE_FILE, {"seen":[], "last_run":0})
+    raw = state.get("seen") or []
+    state["seen"], state["ttl"] = set(), []
+    if isinstance(raw, dict):
+        # định dạng cũ {feed: {id: ts}}
+        raw = [(ts, _id, feed) for feed, items in raw.items() for _id, ts in items.items()]
+    for ts, _id, feed in raw:
+        _mark_seen(state, feed, _id, ts)
+    if SEEN_LOG.exists():
+        for line in SEEN_LOG.read_bytes().splitlines():
+            try:
+                feed, _id, ts = orjson.loads(line) if orjson is not None else json.loads(line)
+            except Exception:
+                continue  # dòng cuối ghi dở (job bị huỷ giữa chừng)
+            _mark_seen(state, feed, _id, ts)
+    return state
+
+def prune_state(state: Dict, cutoff_ts: int):
+    """Bỏ các id cũ hơn cutoff_ts: chỉ pop phần đầu heap đã hết hạn, O(k log n)."""
+    seen, heap = state["seen"], state["ttl"]
+    while heap and heap[0][0] < cutoff_ts:
+        _, _id, _ = heapq.heappop(heap)
+        seen.discard(_id)
+
+def save_state(state: Dict, journal: List[Tuple[str, str, int]]):
+    """
+    Chỉ append các id mới vào SEEN_LOG (O(số bài mới) byte/lần chạy).
+    Gộp lại snapshot + làm rỗng log khi log > 2× snapshot (hoặc chưa có snapshot);
+    last_run vì vậy chỉ được ghi xuống đĩa lúc gộp. Snapshot lưu heap dưới dạng list [ts, id, feed].
+    """
+    snap_size = STATE_FILE.stat().st_size if STATE_FILE.exists() else 0
+    log_size = SEEN_LOG.stat().st_size if SEEN_LOG.exists() else 0
+    if snap_size == 0 or log_size > 2 * snap_size:
+        save_json(STATE_FILE, {"seen": state["ttl"], "last_run": state.get("last_run", 0)})
+        SEEN_LOG.parent.mkdir(parents=True, exist_ok=True)
+        SEEN_LOG.write_bytes(b"")
+        return
+    SEEN_LOG.parent.mkdir(parents=True, exist_ok=True)
+    with SEEN_LOG.open("ab") as fh:  # luôn tạo file log (kể cả rỗng) để bước `git add` của workflow không lỗi
+        if journal:
+            fh.write(b"".join(_dumps_line(rec) for rec in journal))
+
+_TRACKING_PARAMS = ("utm_", "fbclid", "gclid")
+
+def _feed_url_key(u: str) -> str:
+    # khoá khử trùng: scheme/host viết thường, bỏ "/" cuối, fragment và tham số tracking
+    p = urlsplit(u)
+    q = [(k, v) for k, v in parse_qsl(p.query, keep_blank_values=True) if not k.lower().startswith(_TRACKING_PARAMS)]
+    return urlunsplit((p.scheme.lower(), p.netloc.lower(), p.path.rstrip("/"), urlencode(q), ""))
 
 def parse_opml(opml_path: Path) -> List[str]:
-    import xml.etree.ElementTree as ET
-    urls = []
-    tree = ET.parse(opml_path)
-    root = tree.getroot()
-    body = root.find("body")
-    if body is None:
-        return urls
-    def walk(e):
-        for c in e:
-            if c.tag.lower().endswith("outline"):
-                xml = c.attrib.get("xmlUrl") or c.attrib.get("xmlurl") or ""
-                if xml:
-                    urls.append(xml.strip())
-                if list(c):
-                    yield from walk(c)
-    for _ in walk(body):  # consume generator
-        pass
+    # iterparse streaming: không giữ cả cây OPML trong bộ nhớ; khử trùng theo URL chuẩn hoá, vẫn tải URL gốc
     out, seen = [], set()
-    for u in urls:
-        if u and u not in seen:
-            out.append(u); seen.add(u)
+    for _, el in etree.iterparse(str(opml_path), events=("end",), tag="{*}outline"):
+        u = (el.get("xmlUrl") or el.get("xmlurl") or "").strip()
+        key = _feed_url_key(u) if u else ""
+        if key and key not in seen:
+            out.append(u); seen.add(key)
+        el.clear()
     return out
 
+_RULE_TOKEN_RE = re.compile(r'"[^"]+"|\S+', re.UNICODE)
+
 def parse_rules(lines: List[str]):
     rules = []
     for raw in lines:
         s = raw.strip()
         if not s or s.startswith("#"):
             continue
-        parts = re.findall(r'"[^"]+"|\S+', s, flags=re.UNICODE)
+        parts = _RULE_TOKEN_RE.findall(s)
         clause, group = [], []
         for tok in parts:
             up = tok.upper()
@@ -88,23 +190,93 @@ def parse_rules(lines: List[str]):
             rules.append(clause)
     return rules
 
-def text_matches(text: str, rules) -> bool:
-    if not rules:
-        return True
-    s = text.lower()
-    for clause in rules:
-        for group in clause:
-            if all(term in s for term in group):
-                return True
-    return False
+class RuleMatcher:
+    """Distinct terms in one Aho-Corasick automaton; AND/OR clauses checked over the hit set."""
+    def __init__(self, rules):
+        self.rules = rules
+        # clause/group đều nối bằng OR → gộp phẳng thành 1 danh sách nhóm AND
+        self.groups = [tuple(group) for clause in rules for group in clause]
+        # đường dự phòng: term encode sẵn 1 lần, text encode 1 lần/entry
+        self.groups_b = [tuple(t.encode("utf-8") for t in g) for g in self.groups]
+        # toàn OR (mỗi nhóm AND chỉ 1 term): gộp thành 1 regex bytes, search dừng ngay ở hit đầu tiên
+        self.any_re = None
+        if self.groups and all(len(g) == 1 for g in self.groups_b):
+            alts = sorted({g[0] for g in self.groups_b}, key=len, reverse=True)
+            self.any_re = re.compile(b"|".join(re.escape(t) for t in alts))
+        self.automaton = None
+        terms = {t for group in self.groups for t in group if t}
+        if ahocorasick is not None and terms:
+            A = ahocorasick.Automaton()
+            for t in terms:
+                A.add_word(t, t)
+            A.make_automaton()
+            self.automaton = A
+
+    def matches(self, text: str) -> bool:
+        if not self.rules:
+            return True
+        s = text.lower()
+        if self.any_re is not None:
+            return self.any_re.search(s.encode("utf-8")) is not None
+        if self.automaton is None:
+            sb = s.encode("utf-8")
+            return any(all(term in sb for term in group) for group in self.groups_b)
+        hits = {t for _, t in self.automaton.iter(s)}
+        hits.add("")  # term rỗng luôn khớp (như `"" in s`)
+        return any(all(term in hits for term in group) for group in self.groups)
+
+    def matches_many(self, texts: List[str]) -> List[bool]:
+        """Bản theo lô của matches(): nối các text bằng NUL, automaton quét 1 lượt, map hit về text theo offset."""
+        if not self.rules:
+            return [True] * len(texts)
+        if self.any_re is not None:
+            search = self.any_re.search
+            return [search(t.lower().encode("utf-8")) is not None for t in texts]
+        if self.automaton is None or not texts:
+            return [self.matches(t) for t in texts]
+        lowered = [t.lower() for t in texts]
+        starts, pos = [], 0
+        for t in lowered:
+            starts.append(pos); pos += len(t) + 1
+        hits = [{""} for _ in lowered]
+        for end, term in self.automaton.iter("\0".join(lowered)):
+            hits[bisect_right(starts, end) - 1].add(term)
+        return [any(all(term in h for term in group) for group in self.groups) for h in hits]
 
 def norm_id(entry) -> str:
     for k in ("id", "guid", "link"):
         if entry.get(k):
             return entry.get(k)
-    combo = (entry.get("title","") + "|" + entry.get("link","") + "|" + str(entry.get("published",""))).encode("utf-8","ignore")
+    combo = _id_combo(entry)
+    if xxhash is not None:
+        return "h:"+xxhash.xxh3_64_hexdigest(combo)  # chỉ để khử trùng, không cần băm mật mã
     return "h:"+hashlib.sha1(combo).hexdigest()
 
+def _id_combo(entry) -> bytes:
+    return (entry.get("title","") + "|" + entry.get("link","") + "|" + str(entry.get("published",""))).encode("utf-8","ignore")
+
+def legacy_id(entry, _id: str):
+    """Id sha1 cũ (40 hex) cho entry băm xxh3 — để state cũ vẫn nhận ra bài đã gửi."""
+    if len(_id) == 18 and _id.startswith("h:"):
+        return "h:"+hashlib.sha1(_id_combo(entry)).hexdigest()
+    return None
+
+_TAG_RE = re.compile(r"<[^>]+>")
+
+def summary_text(desc: str) -> str:
+    """Text thuần của summary/description: bỏ thẻ, nội dung script/style và thuộc tính, giải mã entity."""
+    if not desc:
+        return ""
+    if "<" not in desc:
+        return html.unescape(desc).strip()  # text thuần: khỏi dựng cây HTML
+    try:
+        frag = lxml_html.fragment_fromstring(desc, create_parent=True)
+        etree.strip_elements(frag, "script", "style", with_tail=False)  # feedparser không sanitize nữa: tự bỏ nội dung script/style
+        text = " ".join(frag.itertext())
+    except Exception:  # HTML hỏng: bỏ thẻ thô bằng regex
+        text = html.unescape(_TAG_RE.sub(" ", desc))
+    return " ".join(text.split())
+
 def entry_summary(entry) -> str:
     parts = []
     if entry.get("title"):
@@ -113,111 +285,175 @@ def entry_summary(entry) -> str:
         parts.append(f"<i>{html.escape(entry.published)}</i>")
     if entry.get("link"):
         parts.append(f'<div><a href="{html.escape(entry.link)}">{html.escape(entry.link)}</a></div>')
-    desc = entry.get("summary") or entry.get("description") or ""
-    if desc:
-        clean = BeautifulSoup(desc, "lxml").get_text(" ", strip=True)
+    clean = summary_text(entry.get("summary") or entry.get("description") or "")
+    if clean:
         if len(clean) > 500:
             clean = clean[:500] + "…"
         parts.append(f"<div>{html.escape(clean)}</div>")
     return "<br/>".join(parts)
 
-def send_email(subject: str, html_body: str):
-    host = os.environ.get('SMTP_HOST', 'smtp.gmail.com')
-    port = int(os.environ.get('SMTP_PORT', '465'))
-    user = os.environ.get('SMTP_USER')
-    password = os.environ.get('SMTP_PASS')
-    from_addr = os.environ.get('SMTP_FROM', user)
-    to_addrs = [x.strip() for x in os.environ.get('SMTP_TO', '').split(',') if x.strip()]
-    if not (user and password and to_addrs):
-        print("SMTP not set; skip email."); return
-    msg = MIMEMultipart(); msg['From']=from_addr; msg['To']=', '.join(to_addrs); msg['Subject']=subject
-    msg.attach(MIMEText(html_body, 'html', 'utf-8'))
-    if os.environ.get('DRY_RUN')=='1':
-        print("DRY_RUN=1 -> not sending email. Subject:", subject); return
-    try:
-        if port==465:
-            with smtplib.SMTP_SSL(host, port) as s: s.login(user,password); s.send_message(msg)
-        else:
-            with smtplib.SMTP(host, port) as s: s.ehlo(); s.starttls(); s.login(user,password); s.send_message(msg)
-        print("Email sent to:", ', '.join(to_addrs))
-    except smtplib.SMTPAuthenticationError as e:
-        print("SMTPAuthenticationError:", e); raise
+class SmtpSender:
+    """1 phiên SMTP/lần chạy: kết nối (TLS + AUTH) mở lúc send() đầu tiên, dùng lại cho các mail sau."""
+    def __init__(self):
+        self.host = os.environ.get('SMTP_HOST', 'smtp.gmail.com')
+        self.port = int(os.environ.get('SMTP_PORT', '465'))
+        self.user = os.environ.get('SMTP_USER')
+        self.password = os.environ.get('SMTP_PASS')
+        self.from_addr = os.environ.get('SMTP_FROM', self.user)
+        self.to_addrs = [x.strip() for x in os.environ.get('SMTP_TO', '').split(',') if x.strip()]
+        self.smtp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.smtp is not None:
+            try: self.smtp.quit()
+            except smtplib.SMTPException: self.smtp.close()
+            self.smtp = None
+
+    def send(self, subject: str, html_body: str):
+        if not (self.user and self.password and self.to_addrs):
+            print("SMTP not set; skip email."); return
+        msg = MIMEMultipart(); msg['From']=self.from_addr; msg['To']=', '.join(self.to_addrs); msg['Subject']=subject
+        msg.attach(MIMEText(html_body, 'html', 'utf-8'))
+        if os.environ.get('DRY_RUN')=='1':
+            print("DRY_RUN=1 -> not sending email. Subject:", subject); return
+        if self.smtp is None:
+            try:
+                if self.port==465:
+                    s = smtplib.SMTP_SSL(self.host, self.port)
+                else:
+                    s = smtplib.SMTP(self.host, self.port); s.ehlo(); s.starttls()
+                s.login(self.user, self.password)
+            except smtplib.SMTPAuthenticationError as e:
+                print("SMTPAuthenticationError:", e); raise
+            self.smtp = s
+        self.smtp.send_message(msg)
+        print("Email sent to:", ', '.join(self.to_addrs))
 
 async def fetch_feed(session: aiohttp.ClientSession, url: str, cache: Dict) -> Tuple[str, bytes, Dict]:
-    headers = {"User-Agent":"Mozilla/5.0 RSS-Watcher/fast"}
+    headers = {"User-Agent":"Mozilla/5.0 RSS-Watcher/fast", "Accept-Encoding": ACCEPT_ENCODING}
     meta = cache.get(url, {})
     if (et := meta.get("etag")):
         headers["If-None-Match"] = et
     if (lm := meta.get("last_modified")):
         headers["If-Modified-Since"] = lm
     try:
-        async with session.get(url, headers=headers, timeout=REQ_TIMEOUT, allow_redirects=True) as resp:
+        async with session.get(url, headers=headers, allow_redirects=True) as resp:
             if resp.status == 304:
                 return url, b"", meta
-            content = await resp.read()
+            if (resp.content_length or 0) > MAX_FEED_BYTES:
+                return url, b"", {"error": f"body > {MAX_FEED_BYTES} bytes", "fetched_at": _now_ts()}
+            # đọc theo chunk: băm dần và dừng sớm khi quá MAX_FEED_BYTES thay vì buffer cả body rồi mới xét
+            digest = hashlib.blake2b(digest_size=16)
+            chunks, size = [], 0
+            async for chunk in resp.content.iter_chunked(64 * 1024):
+                size += len(chunk)
+                if size > MAX_FEED_BYTES:
+                    return url, b"", {"error": f"body > {MAX_FEED_BYTES} bytes", "fetched_at": _now_ts()}
+                digest.update(chunk)
+                chunks.append(chunk)
+            content = b"".join(chunks)
             new_meta = {
                 "etag": resp.headers.get("ETag"),
                 "last_modified": resp.headers.get("Last-Modified"),
                 "fetched_at": _now_ts(),
-                "status": resp.status
+                "status": resp.status,
+                "content_hash": digest.hexdigest(),
             }
+            if new_meta["content_hash"] == meta.get("content_hash"):
+                # server không có ETag nhưng body y hệt lần trước: bỏ qua như 304, khỏi parse lại
+                return url, b"", new_meta
             return str(resp.url), content, new_meta
     except Exception as e:
         return url, b"", {"error": str(e), "fetched_at": _now_ts()}
 
-async def main_async(feeds: List[str], rules, state: Dict, cache: Dict):
-    sem = asyncio.Semaphore(MAX_CONCURRENCY)
-    async with aiohttp.ClientSession() as session:
-        async def run(u):
-            async with sem:
-                return await fetch_feed(session, u, cache)
-        results = await asyncio.gather(*[run(u) for u in feeds])
+def parse_entries(content: bytes) -> list:
+    # chạy trong process con: chỉ trả entries về để giảm chi phí pickle
+    return feedparser.parse(content).get("entries") or []
 
-    seen = state.setdefault("seen", {})
+async def main_async(feeds: List[str], rules, state: Dict, cache: Dict, journal: List[Tuple[str, str, int]]):
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    loop = asyncio.get_running_loop()
+    seen = state["seen"]
     hits = []
     cutoff_ts = _now_ts() - MAX_ENTRY_AGE_DAYS*86400
 
-    for (final_url, content, meta), orig in zip(results, feeds):
-        cache[orig] = {**cache.get(orig, {}), **meta}
-        if not content:
-            # 304 hoặc lỗi: bỏ qua
-            continue
-        d = feedparser.parse(content)
-        if not d or not d.get("entries"):
-            continue
-        feed_seen = seen.setdefault(orig, {})
-        for e in d.entries:
-            _id = norm_id(e)
-            if _id in feed_seen:
-                continue
-            if e.get("published_parsed"):
-                import time as _t
-                ts = int(_t.mktime(e.published_parsed))
-                if ts < cutoff_ts:
+    # pool kết nối dùng chung: cache DNS + giữ keep-alive, tránh bắt tay TLS lại cho feed cùng host
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENCY, limit_per_host=LIMIT_PER_HOST,
+                                     ttl_dns_cache=300, use_dns_cache=True, keepalive_timeout=60)
+    # sock_connect chứ không phải connect: `connect` tính cả thời gian chờ slot trống trong pool
+    timeout = aiohttp.ClientTimeout(total=REQ_TIMEOUT, sock_connect=5)
+    with ProcessPoolExecutor(max_workers=PARSE_WORKERS) as pool:
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            async def run(u):
+                async with sem:
+                    _, content, meta = await fetch_feed(session, u, cache)
+                if not content:
+                    # 304 hoặc lỗi: bỏ qua
+                    return u, meta, []
+                # parse ở process khác: event loop vẫn nhận tiếp các response đang tải
+                try:
+                    entries = await loop.run_in_executor(pool, parse_entries, content)
+                except Exception as e:
+                    # xoá validator: cache[orig] được merge nên phải ghi đè None, nếu không lần sau 304/trùng hash
+                    # sẽ bỏ qua feed dù entries chưa từng được xử lý
+                    meta = {**meta, "etag": None, "last_modified": None, "content_hash": None, "error": f"parse: {e}"}
+                    entries = []
+                return u, meta, entries
+
+            for fut in asyncio.as_completed([run(u) for u in feeds]):
+                orig, meta, entries = await fut
+                cache[orig] = {**cache.get(orig, {}), **meta}
+                if not entries:
                     continue
-            title = e.get("title") or ""
-            desc  = e.get("summary") or e.get("description") or ""
-            if text_matches(f"{title}\n{desc}", rules):
-                hits.append((orig, e, _id))
-                feed_seen[_id] = _now_ts()
+                fresh, fresh_ids = [], set()
+                for e in entries:
+                    _id = norm_id(e)
+                    if _id in seen or _id in fresh_ids or legacy_id(e, _id) in seen:
+                        continue
+                    pp = e.get("published_parsed")  # struct_time UTC → timegm, không tra múi giờ như mktime
+                    if pp and timegm(pp) < cutoff_ts:
+                        continue
+                    fresh.append((e, _id)); fresh_ids.add(_id)
+                # so khớp cả feed trong 1 lần gọi thay vì từng entry
+                texts = [f"{e.get('title') or ''}\n{summary_text(e.get('summary') or e.get('description') or '')}" for e, _ in fresh]
+                for (e, _id), matched in zip(fresh, rules.matches_many(texts)):
+                    if not matched or _id in seen:
+                        continue  # _id in seen: cùng bài đã khớp ở feed khác trong lần chạy này
+                    hits.append((orig, e, _id))
+                    ts = _now_ts()
+                    _mark_seen(state, orig, _id, ts)
+                    journal.append((orig, _id, ts))
+
+    return len(hits), build_messages(feeds, hits)
 
+def build_messages(feeds: List[str], hits: list) -> List[Tuple[str, str]]:
+    """[(subject, html)]: 1 email tổng hợp, hoặc mỗi feed 1 email khi EMAIL_PER_FEED=1."""
     if not hits:
-        return 0, ""
+        return []
+    if not EMAIL_PER_FEED:
+        return [(f"[RSS Watcher] {len(hits)} bài mới khớp bộ lọc", render_email(feeds, hits))]
+    per_feed = {f: [] for f in feeds}
+    for hit in hits:
+        per_feed.setdefault(hit[0], []).append(hit)
+    return [(f"[RSS Watcher] {len(fh)} bài mới khớp bộ lọc — {f}", render_email([f], fh))
+            for f, fh in per_feed.items() if fh]
 
-    from collections import defaultdict
-    groups = defaultdict(list)
+def render_email(feeds: List[str], hits: list) -> str:
+    # as_completed trả theo thứ tự xong trước; nhóm lại theo thứ tự OPML cho email ổn định
+    groups = {f: [] for f in feeds}
     for f, e, _ in hits:
-        groups[f].append(e)
-
-    html_parts = ['<div style="font-family:Arial,Helvetica,sans-serif;font-size:14px">']
-    html_parts.append(f"<h2>RSS Watcher — {len(hits)} bài mới khớp bộ lọc</h2>")
-    for f, entries in groups.items():
-        html_parts.append(f'<h3 style="margin-top:16px">{html.escape(f)}</h3><ul>')
-        for e in entries:
-            html_parts.append("<li>"+entry_summary(e)+"</li>")
-        html_parts.append("</ul>")
-    html_parts.append("</div>")
-    return len(hits), "\n".join(html_parts)
+        groups.setdefault(f, []).append(e)
+    return "\n".join(chain(
+        ['<div style="font-family:Arial,Helvetica,sans-serif;font-size:14px">',
+         f"<h2>RSS Watcher — {len(hits)} bài mới khớp bộ lọc</h2>"],
+        (f'<h3 style="margin-top:16px">{html.escape(f)}</h3><ul>'
+         + "".join(f"<li>{entry_summary(e)}</li>" for e in entries) + "</ul>"
+         for f, entries in groups.items() if entries),
+        ["</div>"],
+    ))
 
 def cli():
     if len(sys.argv) < 3:
@@ -227,20 +463,24 @@ def cli():
     kw = Path(sys.argv[2])
     feeds = parse_opml(opml)
     lines = kw.read_text(encoding="utf-8").splitlines() if kw.exists() else []
-    rules = parse_rules(lines)
+    rules = RuleMatcher(parse_rules(lines))
 
-    state = load_json(STATE_FILE, {"seen":{}, "last_run":0})
+    state = load_state()
+    if SEEN_TTL_DAYS > 0:
+        prune_state(state, _now_ts() - SEEN_TTL_DAYS*86400)
     cache = load_json(CACHE_FILE, {})
+    journal: List[Tuple[str, str, int]] = []
 
-    count, body = asyncio.run(main_async(feeds, rules, state, cache))
+    count, messages = asyncio.run(main_async(feeds, rules, state, cache, journal))
 
     state["last_run"] = _now_ts()
-    save_json(STATE_FILE, state)
+    save_state(state, journal)
     save_json(CACHE_FILE, cache)
 
     if count > 0:
-        subject = f"[RSS Watcher] {count} bài mới khớp bộ lọc"
-        send_email(subject, body)
+        with SmtpSender() as sender:
+            for subject, body in messages:
+                sender.send(subject, body)
     else:
         print("No new matching items.")
 